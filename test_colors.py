@@ -11,51 +11,207 @@ Dependencies:
   - pytest
 """
 
-import pytest, colors 
+import pytest, colors, cv2
 from _mock_helper import set_keyboard_input, get_display_output # for mocking user input
 import numpy as np
-from multiprocessing import Value, Queue, Event
+import errno, os, signal, threading, time
+from multiprocessing import RawValue, Condition, Event, Process, Semaphore, get_context
+from queue import Empty, Full
 
 @pytest.mark.parametrize("input,expected", [
-    ([0,0,0], [255,255,255]), # complement of white should be black
+    ([0,0,0], [255,255,255]), # complement of black should be white
     ([0,255,0], [255,0,255]), # complement of green should be fuchsia
-    ([255,0,0], [0,255,255])  # complement of red should be aqua
+    ([0,0,255], [255,255,0]), # complement of red should be aqua (B,G,R)
+    ((0,255,255), [255,0,0])  # works on plain tuples too: yellow -> blue (B,G,R)
 ])
 def test_get_complement_color(input,expected):
     """Gets complementary colors for example inputs and checks
        they match expected complementary colors"""
-    output = colors.get_complement_color(np.array(input))
+    if isinstance(input, list):
+        input = np.array(input)
+    output = colors.get_complement_color(input)
     assert output == expected 
 
 
-@pytest.mark.parametrize("exp_num_images,width,height,queue_a,event_quit", [
-    (Value("I",100), Value("I", 8), Value("I", 6), Queue(), Event()),
-    (Value("I",50), Value("I", 246), Value("I", 379), Queue(), Event()),
-    (Value("I",5), Value("I", 2470), Value("I", 1569), Queue(), Event())
+@pytest.mark.parametrize("width,height", [(1,1), (8,6), (246,379), (2470,1569)])
+def test_fill_image(width,height):
+    """Fills images of different sizes with every color and checks each pixel"""
+    image = np.zeros((height,width,3), dtype=np.uint8)
+    for color in colors.COLOR_BGR:
+        colors.fill_image(image, color)
+        assert (image == color).all()
+
+
+def fill_slots(slots):
+    """Child side of test_image_slots, runs in a separate (spawned) process"""
+    for slot in range(len(slots)):
+        colors.fill_image(slots[slot], colors.COLOR_BGR[slot])
+
+def test_image_slots():
+    """Fills slots from a spawned process (slots re-attach by path) & checks parent sees them"""
+    slots = colors.ImageSlots(3, 8, 6)
+    try:
+        p = get_context("spawn").Process(target=fill_slots, args=(slots,))
+        p.start()
+        p.join(timeout=30)
+        assert p.exitcode == 0
+        for slot in range(len(slots)):
+            assert (slots[slot] == colors.COLOR_BGR[slot]).all()
+    finally:
+        slots.release()
+    assert not os.path.exists(slots.path)
+
+
+def test_image_slots_no_room(monkeypatch, tmp_path):
+    """Slots go to temp dir when /dev/shm is too small, and if there's no room
+       there either, fail right away (not w/ SIGBUS later) w/o leaving a file"""
+    monkeypatch.setattr(colors.tempfile, "tempdir", str(tmp_path))
+    statvfs = os.statvfs
+    def full_statvfs(path):
+        st = statvfs(path)
+        return os.statvfs_result((st.f_bsize, st.f_frsize, st.f_blocks, 0, 0, *st[5:]))
+    monkeypatch.setattr(colors.os, "statvfs", full_statvfs)
+    slots = colors.ImageSlots(3, 8, 6)
+    try:
+        assert os.path.dirname(slots.path) == str(tmp_path)
+    finally:
+        slots.release()
+
+    if hasattr(os, "posix_fallocate"):
+        def no_room(fd, offset, size):
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        monkeypatch.setattr(colors.os, "posix_fallocate", no_room)
+        with pytest.raises(OSError):
+            colors.ImageSlots(3, 8, 6)
+        assert not list(tmp_path.iterdir())
+
+
+def produce_ring_items(ring, num_items):
+    """Producer side of test_spsc_ring, runs in a separate process"""
+    for i in range(num_items):
+        ring.put((i, i % 7))
+    ring.put(None)
+
+def test_spsc_ring():
+    """Checks ring buffer keeps FIFO order while wrapping around, raises
+       Full/Empty like a queue, rejects items too big for an entry,
+       and hands items across processes intact"""
+    ring = colors.SPSCRing(4)
+    assert ring.empty()
+    with pytest.raises(Empty):
+        ring.get(timeout=0.01)
+    for _ in range(3): # wrap around a few times
+        for i in range(4):
+            ring.put((i, 2*i, 3*i))
+        with pytest.raises(Full):
+            ring.put((5,), block=False)
+        assert [ring.get() for _ in range(4)] == [(i, 2*i, 3*i) for i in range(4)]
+        assert ring.empty()
+    ring.put(None)
+    assert ring.get() is None
+    # items have to fit in their entry, after the tag
+    ring.put(tuple(range(colors._LINE_WORDS - 1)))
+    assert ring.get() == tuple(range(colors._LINE_WORDS - 1))
+    with pytest.raises(ValueError):
+        ring.put(tuple(range(colors._LINE_WORDS)))
+    assert ring.empty()
+
+    # small ring so producer constantly waits on consumer (and vice versa)
+    ring = colors.SPSCRing(8)
+    producer = Process(target=produce_ring_items, args=(ring, 5000))
+    producer.start()
+    items = []
+    while True:
+        item = ring.get(timeout=5)
+        if item is None: break
+        items.append(item)
+    producer.join()
+    assert items == [(i, i % 7) for i in range(5000)]
+
+
+@pytest.mark.parametrize("exp_num_images,width,height,queues_a,event_quit", [
+    (RawValue("I",100), 8, 6, [colors.SPSCRing(101)], Event()),
+    (RawValue("I",50), 246, 379, [colors.SPSCRing(26), colors.SPSCRing(26)], Event()),
+    (RawValue("I",5), 2470, 1569, [colors.SPSCRing(3) for _ in range(3)], Event())
 ])
-def test_generate_rgb_images(exp_num_images,width,height,queue_a,event_quit):
+def test_generate_rgb_images(exp_num_images,width,height,queues_a,event_quit):
     """Goes through every image output by generate function and checks
        expected dimensions & number of output images is correct.
-       Also checks that the upper-left most pixel is in RGB_COLORS dict.
+       Also checks that the upper-left most pixel is in COLOR_BGR
+       and matches the color index passed along with the image.
+       Images should be dealt out to queues_a round robin.
     """
     # TODO: incorporate event_quit, test currently overlooks this
     num_images_generated = 0
-    colors.generate_rgb_images(exp_num_images,width,height,queue_a,event_quit)
+    # one slot per image, so the generator never waits on a slot to be freed
+    slots = colors.ImageSlots(exp_num_images.value, width, height)
+    try:
+        free_slots = Semaphore(len(slots))
+        colors.generate_rgb_images(exp_num_images,slots,free_slots,queues_a,event_quit)
     
-    # loop through each image produced by function (stored in queue_a)
-    # not using condition here to make sure queue gets flushed
-    while True:
-        img = queue_a.get(timeout=1)
-        if img is None: break
-        num_images_generated += 1
-
-        # Check image has expected dimensions
-        assert img.shape == (height.value,width.value,3)
-        # Check that the color of upper-left most pixel is in RGB_COLORS dict
-        assert tuple(img[0][0]) in colors.RGB_COLORS
+        # loop through each image produced by function (stored in queues_a, in turn)
+        # not using condition here to make sure queue gets flushed
+        while True:
+            item = queues_a[num_images_generated % len(queues_a)].get(timeout=1)
+            if item is None: break
+            num_images_generated += 1
+            slot, color = item
+            # Check slots are used round robin
+            assert slot == (num_images_generated - 1) % len(slots)
+
+            # Check image has expected dimensions
+            assert slots[slot].shape == (height,width,3)
+            # Check that the color of upper-left most pixel is in COLOR_BGR
+            assert tuple(slots[slot][0][0]) in colors.COLOR_BGR
+            assert colors.COLOR_BGR[color] == tuple(slots[slot][0][0])
     
-    # Check if we generated the number of images we expected
-    assert num_images_generated == exp_num_images.value
+        # Check if we generated the number of images we expected
+        assert num_images_generated == exp_num_images.value
+        # every other queue should be left with just the end of stream sentinel
+        for queue_a in queues_a:
+            if not queue_a.empty():
+                assert queue_a.get() is None
+                assert queue_a.empty()
+    finally:
+        slots.release()
+
+
+@pytest.mark.skipif(not colors.gpu_available(), reason="needs OpenCV w/ CUDA device")
+def test_generate_rgb_images_gpu():
+    """Generates images on GPU and checks each one is filled with its color"""
+    slots = colors.ImageSlots(10, 64, 48)
+    try:
+        queue_a = colors.SPSCRing()
+        colors.generate_rgb_images(RawValue("I",10),slots,Semaphore(len(slots)),
+                                   [queue_a],Event(),use_gpu=True)
+        num_images_generated = 0
+        while True:
+            item = queue_a.get(timeout=1)
+            if item is None: break
+            num_images_generated += 1
+            slot, color = item
+            assert (slots[slot] == colors.COLOR_BGR[color]).all()
+        assert num_images_generated == 10
+    finally:
+        slots.release()
+
+
+@pytest.mark.parametrize("width,height", [(1,1), (55,50), (2470,1569)])
+def test_make_watermark(width,height):
+    """Stamps each color's watermark onto an image of that color and checks
+       it only ever writes the complementary color, inside the image center"""
+    for color, bgr in enumerate(colors.COLOR_BGR):
+        area, mask, stamp = colors.make_watermark(height, width, color)
+        assert mask.base is None # cropped mask is its own array, not a view of full one
+        image = np.empty((height,width,3), dtype=np.uint8)
+        colors.fill_image(image, bgr)
+        cv2.copyTo(stamp, mask, image[area])
+
+        comp_color = colors.get_complement_color(bgr)
+        stamped = (image == comp_color).all(axis=2)
+        assert stamped.sum() == np.count_nonzero(mask)
+        assert (image[~stamped] == bgr).all() # rest of image untouched
+        assert stamped[height//2, width//2] # center of circle
 
 
 def test_watermark_images():
@@ -63,39 +219,98 @@ def test_watermark_images():
        for exact match with expected images. Uses example_generated_images.npz
        and example_watermarked_images.npz to accomplish this.
     """
-    queue_a = Queue()
-    queue_b = Queue()
+    queue_a = colors.SPSCRing()
+    queue_b = colors.SPSCRing()
     event_quit = Event()
 
-    # Populate queue_a with RGB images from sample file
+    # Populate slots & queue_a with RGB images from sample file, flipped to BGR
     input_images = np.load("example_generated_images.npz")
-    for output_image in input_images:
-        queue_a.put(input_images[output_image], timeout=1)
-    queue_a.put(None, timeout=1) # must put sentinel to indicate end
-
-    colors.watermark_images(queue_a, queue_b,event_quit)
-    num_images_watermarked = 0
-    i = 0
-
-    # comparing output of watermark_images function to these images
-    expected_images = np.load("example_watermarked_images.npz")
-    # TODO: refactor below so don't need to list out names
-    # using this list to iterate over each image in same loop
-    array_names = 'arr_0 arr_1 arr_2 arr_3 arr_4 arr_5 arr_6 arr_7 arr_8 arr_9'.split()
-
-    # loop through each image produced by function (stored in queue_b)
-    # not using condition here to make sure queue gets flushed
-    while True:
-        output_image = queue_b.get(timeout=1)
-        if output_image is None: break
-        num_images_watermarked += 1
+    height, width = input_images['arr_0'].shape[:2]
+    slots = colors.ImageSlots(len(input_images), width, height)
+    try:
+        for slot, output_image in enumerate(input_images):
+            slots[slot][:] = input_images[output_image][..., ::-1]
+            color = colors.COLOR_BGR.index(tuple(slots[slot][0][0]))
+            queue_a.put((slot, color), timeout=1)
+        queue_a.put(None, timeout=1) # must put sentinel to indicate end
+
+        colors.watermark_images(queue_a, queue_b, slots, event_quit)
+        num_images_watermarked = 0
+        i = 0
+
+        # comparing output of watermark_images function to these images
+        expected_images = np.load("example_watermarked_images.npz")
+        # TODO: refactor below so don't need to list out names
+        # using this list to iterate over each image in same loop
+        array_names = 'arr_0 arr_1 arr_2 arr_3 arr_4 arr_5 arr_6 arr_7 arr_8 arr_9'.split()
+
+        # loop through each image produced by function (stored in queue_b)
+        # not using condition here to make sure queue gets flushed
+        while True:
+            item = queue_b.get(timeout=1)
+            if item is None: break
+            num_images_watermarked += 1
         
-        # checking if output watermarked image exactly matches expected watermarked image
-        assert (output_image==expected_images[array_names[i]]).all() == True
-        i += 1
+            # checking if output watermarked image exactly matches expected watermarked image
+            slot, color = item
+            assert (slots[slot]==expected_images[array_names[i]][..., ::-1]).all() == True
+            i += 1
     
-    # Check if we watermarked the expected number of images
-    assert num_images_watermarked == len(expected_images)
+        # Check if we watermarked the expected number of images
+        assert num_images_watermarked == len(expected_images)
+    finally:
+        slots.release()
+
+
+@pytest.mark.parametrize("num_images,keys,exp_shown", [
+    (1, [13], 1),
+    (3, [13, ord('x'), 13, 13], 3),
+    (3, [ord('x'), ord('q')], 1),
+    (3, [13, colors.NO_WINDOW], 2) # viewer window closed while showing 2nd image
+])
+def test_display_image(monkeypatch, capsys, num_images, keys, exp_shown):
+    """Hands images over to viewer (in a thread) like main process does, w/ imshow
+       & key presses mocked. Viewer must only quit on 'q', <ENTER> on last image
+       or its window getting closed"""
+    slots = colors.ImageSlots(num_images, 4, 3)
+    try:
+        for slot in range(num_images):
+            slots[slot][:] = colors.COLOR_BGR[slot]
+        slot_a, color_a, img_ready = RawValue('i', 0), RawValue('B', 0), RawValue('b', False)
+        cond_img, free_slots, event_quit = Condition(), Semaphore(0), Event()
+
+        shown, quit_before_key = [], []
+        keys = iter(keys)
+        def wait_key(delay):
+            quit_before_key.append(event_quit.is_set())
+            return next(keys)
+        monkeypatch.setattr(colors.cv2, "imshow", lambda name, image: shown.append(tuple(image[0,0])))
+        monkeypatch.setattr(colors.cv2, "waitKey", wait_key)
+
+        viewer = threading.Thread(target=colors.display_image, args=(slots,slot_a,color_a,
+                                  img_ready,cond_img,free_slots,event_quit))
+        viewer.start()
+        for item in [(slot, slot) for slot in range(num_images)] + [None]:
+            with cond_img:
+                cond_img.wait_for(lambda: not img_ready.value or event_quit.is_set())
+                if event_quit.is_set(): break
+                slot_a.value, color_a.value = item if item else (colors.NO_MORE_IMAGES, 0)
+                img_ready.value = True
+                cond_img.notify()
+        with cond_img: # main process waits on this before cleaning up
+            assert cond_img.wait_for(event_quit.is_set, timeout=5)
+        viewer.join(timeout=5)
+        capsys.readouterr()
+
+        assert not viewer.is_alive()
+        assert shown == list(colors.COLOR_BGR[:exp_shown])
+        assert next(keys, None) is None # every key press was waited for...
+        assert not any(quit_before_key) # ...before quitting
+        for _ in range(exp_shown): # every displayed slot handed back
+            assert free_slots.acquire(block=False)
+        assert not free_slots.acquire(block=False)
+    finally:
+        slots.release()
 
 
 @pytest.mark.parametrize("num_a_items,num_b_items", [
@@ -108,18 +323,19 @@ def test_watermark_images():
 def test_cleanup(capsys, num_a_items, num_b_items):
     """Populates queues with dummy items and checks stdout
        to see if expected number of items got flushed"""
-    queue_a = Queue()
-    queue_b = Queue()
+    queue_a = colors.SPSCRing(num_a_items + 1)
+    queue_b = colors.SPSCRing(num_b_items + 1)
 
     for i in range(num_a_items):
-        queue_a.put(i)
+        queue_a.put((i,))
     queue_a.put(None,timeout=1)
 
     for i in range(num_b_items):
-        queue_b.put(i)
+        queue_b.put((i,))
     queue_b.put(None,timeout=1)
 
-    colors.cleanup(queue_a,queue_b,[])
+    event_quit = Event()
+    colors.cleanup([queue_a,queue_b],[],event_quit)
     out, err = capsys.readouterr()
     
     exp_total = num_a_items + num_b_items + 2 # expected number of items flushed from queue
@@ -131,6 +347,23 @@ def test_cleanup(capsys, num_a_items, num_b_items):
     
     assert out == expected_output
     assert queue_a.empty() and queue_b.empty()
+    assert event_quit.is_set()
+
+
+def test_cleanup_stragglers(capsys):
+    """Checks cleanup terminates a process that doesn't exit on its own,
+       and lets one that does exit go without terminating it"""
+    event_quit = Event()
+    straggler = Process(target=time.sleep, args=(60,))
+    quitter = Process(target=event_quit.wait)
+    straggler.start()
+    quitter.start()
+
+    colors.cleanup([colors.SPSCRing()], [quitter, straggler], event_quit)
+    capsys.readouterr()
+
+    assert quitter.exitcode == 0 # exited on its own once event_quit was set
+    assert straggler.exitcode == -signal.SIGTERM
 
 
 @pytest.mark.parametrize("input_list,prompt,type_,min_,expected", [